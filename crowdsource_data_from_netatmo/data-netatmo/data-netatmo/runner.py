@@ -1,15 +1,21 @@
 import csv
+import os
 import time
-from utility import (get_access_token, get_ids, save_netatmo_data_to_csv,
-                     load_device_and_module_ids_from_csv,
+from utility import (get_access_token, get_access_token_async, get_ids_tiled, save_netatmo_data_to_csv,
+                     save_netatmo_data_to_parquet,
+                     iter_device_module_ids_from_parquet,
                      get_historical_measurements,
                      convert_to_unix_timestamp,
-                     get_historical_measurements_batch,
+                     get_historical_measurements_all,
                      save_measurements_to_csv,
-                     format_time)
+                     format_time,
+                     load_etag_cache,
+                     save_etag_cache,
+                     run)
 from input_handler import get_user_inputs
 
 start_time = time.time()
+etag_cache_file = 'netatmo_etag_cache.json'
 
 # Get user inputs
 (lat_ne, lon_ne, lat_sw, lon_sw, start_date_stamp, start_time_stamp,
@@ -19,24 +25,30 @@ start_time = time.time()
 # Get access token
 access_token = get_access_token(client_id, client_secret, refresh_token)
 
-# Get IDs
-ids = get_ids(access_token, lat_ne, lon_ne, lat_sw, lon_sw)
+# Get IDs, sweeping the region tile by tile and reusing unchanged tiles from earlier runs
+n_tiles = 1  # Tiles along each axis, raise for regions with more stations than one request returns
+load_etag_cache(etag_cache_file)
+ids = get_ids_tiled(access_token, lat_ne, lon_ne, lat_sw, lon_sw, n=n_tiles)
+save_etag_cache(etag_cache_file)
+parquet_file = os.path.splitext(csv_file)[0] + '.parquet'
+save_netatmo_data_to_parquet(ids, parquet_file)
 save_netatmo_data_to_csv(ids, csv_file)
 
-# Load device IDs and module IDs from the CSV file
-device_module_ids = load_device_and_module_ids_from_csv(csv_file)
-
-# Iterate through each device ID and module ID pair
-for device_id, module_id in device_module_ids:
-    scale = "1day"  # Change according to your requirement
-    types = "Temperature,Humidity,Pressure"  # Add or remove types as needed
-    date_begin = convert_to_unix_timestamp(start_date_stamp, start_time_stamp)  # Start timestamp
-    date_end = convert_to_unix_timestamp(end_date_stamp, end_time_stamp)  # End timestamp, set to "last" to retrieve only the last measurement
-    limit = 1024  # Default limit
-
-    # Fetch historical measurements for the current device ID and module ID pair
-    measurements = get_historical_measurements_batch(access_token, device_id, module_id, scale, types, date_begin, date_end, limit)
-    print(f'--------data for {device_id, module_id} completely downloaded----------')
+# Stream device IDs and module IDs from the Parquet file
+device_module_ids = iter_device_module_ids_from_parquet(parquet_file)
+
+scale = "1day"  # Change according to your requirement
+types = "Temperature,Humidity,Pressure"  # Add or remove types as needed
+date_begin = convert_to_unix_timestamp(start_date_stamp, start_time_stamp)  # Start timestamp
+date_end = convert_to_unix_timestamp(end_date_stamp, end_time_stamp)  # End timestamp, set to "last" to retrieve only the last measurement
+limit = 1024  # Default limit
+
+# Fetch historical measurements for every device ID and module ID pair concurrently into one database
+db_file = os.path.splitext(csv_file)[0] + '.duckdb'
+# Resolve the token per batch, so the cache refreshes it before it expires on long sweeps
+token_provider = lambda: get_access_token_async(client_id, client_secret, refresh_token)
+run(get_historical_measurements_all(token_provider, device_module_ids, scale, types, date_begin, date_end, limit,
+                                    db_path=db_file))
 
 processing_time_seconds = time.time() - start_time
 processing_time_formatted = format_time(processing_time_seconds)
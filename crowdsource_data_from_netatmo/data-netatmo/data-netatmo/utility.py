@@ -1,7 +1,218 @@
+import ast
+import asyncio
 import csv
-import requests
+import os
+import threading
 import time
+import duckdb
+import httpx
+import numpy as np
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import deque
+from contextlib import aclosing, nullcontext
 from datetime import datetime
+from functools import lru_cache
+from pandas.api.types import infer_dtype
+
+# Shared HTTP/2 client so every Netatmo request reuses the same pooled
+# connections. It is bound to _loop, which the sync wrappers run on.
+# _request retries transport errors (connect and read failures, timeouts)
+# as well as rate-limited and server-error responses.
+_client = httpx.AsyncClient(timeout=30, transport=httpx.AsyncHTTPTransport(
+    http2=True, limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)))
+_loop = asyncio.new_event_loop()
+
+# Response statuses that are retried with backoff
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Netatmo API error codes for a missing, invalid and expired access token
+_TOKEN_ERROR_CODES = {1, 2, 3}
+
+# Turns numpy's 'YYYY-MM-DDTHH:MM' into 'YYYYMMDDHHMM'
+_ACQUISITION_TIME_TABLE = str.maketrans('', '', '-T:')
+
+# Access tokens keyed by (client_id, refresh_token), stored with their expiry
+# time and the latest refresh token Netatmo handed out for them
+_TOKEN_CACHE = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+_TOKEN_REFRESH_LOCK = asyncio.Lock()
+
+# Validators and station columns from the last getpublicdata response,
+# keyed by (lat_ne, lon_ne, lat_sw, lon_sw)
+_ETAG_CACHE = {}
+
+# Column types for the saved station table; the module columns are real lists
+_STATION_SCHEMA = pa.schema([
+    ('MAC_address', pa.string()),
+    ('module_name', pa.list_(pa.string())),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('altitude', pa.float64()),
+    ('city', pa.string()),
+    ('full_modules', pa.list_(pa.string())),
+])
+
+
+def run(coro):
+    """
+    Run a coroutine on the event loop shared with the HTTP client.
+
+    The synchronous wrappers all go through here, so none of them can be
+    called while another event loop is running (e.g. in Jupyter); await the
+    *_async functions there instead.
+
+    Args:
+        coro (coroutine): Coroutine to run.
+
+    Returns:
+        The result of the coroutine.
+
+    Raises:
+        RuntimeError: If called from inside a running event loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return _loop.run_until_complete(coro)
+    coro.close()
+    raise RuntimeError("utility.run() and the synchronous wrappers cannot be used inside a running "
+                       "event loop (e.g. Jupyter); await the *_async functions instead")
+
+class _TokenBucket:
+    """
+    Token bucket limiting how many requests are started per second.
+
+    Over any window of w seconds it lets at most capacity + w * rate
+    requests through.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (int): Maximum number of tokens, i.e. the allowed burst.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        """
+        Wait until a token is available and take it.
+        """
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class _SlidingWindow:
+    """
+    Limit the number of requests started in any window of the given length.
+
+    Unlike a token bucket this never throttles while the window still has
+    room, it only waits once the quota is actually used up.
+
+    Args:
+        limit (int): Maximum number of requests per window.
+        period (float): Window length in seconds.
+    """
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self._starts = deque()
+
+    async def acquire(self):
+        """
+        Wait until the window has room and record a request start.
+        """
+        while True:
+            now = time.monotonic()
+            while self._starts and now - self._starts[0] >= self.period:
+                self._starts.popleft()
+            if len(self._starts) < self.limit:
+                self._starts.append(now)
+                return
+            await asyncio.sleep(self.period - (now - self._starts[0]))
+
+# Netatmo allows 50 requests every 10 seconds (10 + 10 * 4 = 50) and 500 every
+# hour per user. The window is acquired last so its recorded start times match
+# the moment the request is actually sent.
+_RATE_LIMITERS = (_TokenBucket(rate=4, capacity=10), _SlidingWindow(limit=500, period=3600))
+
+def _sleep_hint(response):
+    """
+    Work out how long to pause before the next request from the rate-limit headers.
+
+    Args:
+        response (httpx.Response): Response to inspect.
+
+    Returns:
+        float: Seconds to wait, 0 while the quota is not nearly used up.
+    """
+    try:
+        remaining = int(response.headers['X-RateLimit-Remaining'])
+    except (KeyError, ValueError):
+        return 0
+    if remaining > 1:
+        return 0
+    try:
+        reset = float(response.headers['X-RateLimit-Reset'])
+    except (KeyError, ValueError):
+        return 1
+    # The reset header is either an epoch timestamp or a number of seconds;
+    # anything past 1e9 (September 2001) can only be an epoch timestamp
+    if reset > 1e9:
+        reset -= time.time()
+    # Never wait longer than Netatmo's longest quota window, one hour
+    return min(max(reset, 0), 3600)
+
+async def _request(method, url, sem=None, retries=5, backoff_factor=0.5, **kwargs):
+    """
+    Send a request on the shared client, retrying transport, rate-limited and server errors.
+
+    Between attempts it waits for the Retry-After header when the server
+    sends one, and backoff_factor * 2 ** attempt seconds otherwise.
+
+    Args:
+        method (str): HTTP method.
+        url (str): Request URL.
+        sem (asyncio.Semaphore, optional): Semaphore bounding the number of
+            in-flight requests. Defaults to None (unbounded).
+        retries (int, optional): Number of retries. Defaults to 5.
+        backoff_factor (float, optional): Base backoff in seconds. Defaults to 0.5.
+        **kwargs: Passed on to httpx.AsyncClient.request.
+
+    Returns:
+        httpx.Response: The last response received.
+
+    Raises:
+        httpx.TransportError: If the last attempt failed without a response.
+    """
+    for attempt in range(retries + 1):
+        for limiter in _RATE_LIMITERS:
+            await limiter.acquire()
+        try:
+            async with sem or nullcontext():
+                response = await _client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+            delay = backoff_factor * 2 ** attempt
+        else:
+            if response.status_code not in _RETRY_STATUSES or attempt == retries:
+                return response
+            try:
+                delay = float(response.headers['Retry-After'])
+            except (KeyError, ValueError):
+                delay = backoff_factor * 2 ** attempt
+        # Wait outside the semaphore so the other requests can keep going
+        await asyncio.sleep(delay)
 
 
 def format_time(seconds):
@@ -18,6 +229,7 @@ def format_time(seconds):
     h, m = divmod(m, 60)
     return "%d:%02d:%02d" % (h, m, s)
 
+@lru_cache(maxsize=4096)
 def convert_to_unix_timestamp(date_string, time_string):
     """
     Convert date and time strings to UNIX timestamp.
@@ -28,24 +240,25 @@ def convert_to_unix_timestamp(date_string, time_string):
 
     Returns:
         int: UNIX timestamp.
+
+    Raises:
+        ValueError: If the date or time string is not in the expected format.
     """
     try:
-        # Parse the date and time strings
-        date_obj = datetime.strptime(date_string, '%Y%m%d')
-        time_obj = datetime.strptime(time_string, '%H%M')
-        
-        # Combine date and time
-        datetime_obj = datetime(date_obj.year, date_obj.month, date_obj.day, time_obj.hour, time_obj.minute)
-        
+        # The formats are fixed-width, so slice the fields instead of running strptime
+        if len(date_string) != 8 or len(time_string) != 4 or not (date_string + time_string).isdigit():
+            raise ValueError
+        datetime_obj = datetime(int(date_string[0:4]), int(date_string[4:6]), int(date_string[6:8]),
+                                int(time_string[0:2]), int(time_string[2:4]))
+
         # Convert to UNIX timestamp
         timestamp = int(datetime_obj.timestamp())
         return timestamp
-    except ValueError:
-        print("Error: Invalid input format. Please provide date in 'yyyymmdd' and time in 'hhmm' format.")
-        return None
+    except (TypeError, ValueError):
+        raise ValueError("Invalid input format. Please provide date in 'yyyymmdd' and time in 'hhmm' format.") from None
 
 
-def get_access_token(client_id, client_secret, refresh_token):
+async def get_access_token_async(client_id, client_secret, refresh_token):
     """
     Get access token using client ID, client secret, and refresh token.
 
@@ -57,32 +270,95 @@ def get_access_token(client_id, client_secret, refresh_token):
     Returns:
         str: Access token.
     """
-    # URL for token endpoint
-    token_url = "https://api.netatmo.com/oauth2/token"
+    # One refresh at a time, so concurrent workers waiting on an expired token
+    # share the new one instead of each spending a refresh
+    async with _TOKEN_REFRESH_LOCK:
+        # Reuse the cached token until a minute before it expires
+        key = (client_id, refresh_token)
+        with _TOKEN_CACHE_LOCK:
+            cached = _TOKEN_CACHE.get(key)
+        if cached is not None and time.time() < cached[1] - 60:
+            return cached[0]
+        if cached is not None:
+            # Netatmo may rotate the refresh token, so refresh with the newest one
+            refresh_token = cached[2]
+
+        # URL for token endpoint
+        token_url = "https://api.netatmo.com/oauth2/token"
+
+        # Parameters for token request
+        params = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": client_id,
+            "client_secret": client_secret
+        }
+
+        # Send POST request to get access token
+        response = await _request("POST", token_url, data=params)
+
+        # Check if request was successful
+        if response.status_code == 200:
+            # Parse JSON response
+            token_data = orjson.loads(response.content)
+            # Access token
+            access_token = token_data["access_token"]
+            with _TOKEN_CACHE_LOCK:
+                _TOKEN_CACHE[key] = (access_token, time.time() + token_data["expires_in"],
+                                     token_data.get("refresh_token", refresh_token))
+            return access_token
+        else:
+            print("Error:", response.status_code, response.text)
+            return None
 
-    # Parameters for token request
-    params = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
-        "client_id": client_id,
-        "client_secret": client_secret
-    }
+def get_access_token(client_id, client_secret, refresh_token):
+    """
+    Synchronous wrapper around get_access_token_async.
+    """
+    return run(get_access_token_async(client_id, client_secret, refresh_token))
 
-    # Send POST request to get access token
-    response = requests.post(token_url, data=params)
+def _drop_cached_token(access_token):
+    """
+    Forget a cached access token the API has rejected.
+    """
+    with _TOKEN_CACHE_LOCK:
+        for key, cached in list(_TOKEN_CACHE.items()):
+            if cached[0] == access_token:
+                # Keep the refresh token but mark the access token as expired
+                _TOKEN_CACHE[key] = (cached[0], 0, cached[2])
 
-    # Check if request was successful
-    if response.status_code == 200:
-        # Parse JSON response
-        token_data = response.json()
-        # Access token
-        access_token = token_data["access_token"]
-        return access_token
-    else:
-        print("Error:", response.status_code, response.text)
-        return None
+def load_etag_cache(cache_file):
+    """
+    Load getpublicdata validators saved by a previous run.
 
-def get_ids(access_token, lat_ne, lon_ne, lat_sw, lon_sw):
+    Args:
+        cache_file (str): Path to the JSON cache file. Nothing is loaded if it does not exist.
+    """
+    if not os.path.exists(cache_file):
+        return
+    with open(cache_file, 'rb') as file:
+        for entry in orjson.loads(file.read()):
+            _ETAG_CACHE[tuple(entry['bbox'])] = (entry['etag'], entry['last_modified'], entry['ids'])
+
+def save_etag_cache(cache_file):
+    """
+    Save getpublicdata validators so the next run can send conditional requests.
+
+    Args:
+        cache_file (str): Path to the JSON cache file.
+    """
+    entries = [{'bbox': list(bbox), 'etag': etag, 'last_modified': last_modified, 'ids': ids}
+               for bbox, (etag, last_modified, ids) in _ETAG_CACHE.items()]
+    with open(cache_file, 'wb') as file:
+        file.write(orjson.dumps(entries))
+
+def _new_station_columns():
+    """
+    Return an empty set of station columns, one list per schema field.
+    """
+    return {name: [] for name in _STATION_SCHEMA.names}
+
+async def get_ids_async(access_token, lat_ne, lon_ne, lat_sw, lon_sw, retries=4, sem=None):
     """
     Get IDs of stations within a given region.
 
@@ -92,9 +368,13 @@ def get_ids(access_token, lat_ne, lon_ne, lat_sw, lon_sw):
         lon_ne (float): Longitude of the northeast corner of the region.
         lat_sw (float): Latitude of the southwest corner of the region.
         lon_sw (float): Longitude of the southwest corner of the region.
+        retries (int, optional): Number of times an empty box is requested again.
+            Defaults to 4.
+        sem (asyncio.Semaphore, optional): Semaphore bounding the number of
+            in-flight requests. Defaults to None (unbounded).
 
     Returns:
-        dict: Dictionary containing station IDs and their information.
+        dict: Station data as parallel column lists keyed by column name.
     """
     params = {
         'access_token': access_token,
@@ -104,66 +384,175 @@ def get_ids(access_token, lat_ne, lon_ne, lat_sw, lon_sw):
         'lon_sw' : lon_sw,
     }
 
-    ids = {}
-    NoResponse = True
-    retry_count = 0
-    while NoResponse:
-        #try to get stations in given region, 5 attempts before moving on to next area
+    #send conditional requests so an unchanged box is not downloaded and parsed again
+    bbox = (lat_ne, lon_ne, lat_sw, lon_sw)
+    headers = {}
+    cached = _ETAG_CACHE.get(bbox)
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    #try to get stations in given region, retrying an empty box before moving on to next area
+    for attempt in range(retries + 1):
         try:
             #try to get stations
-            response = requests.post("https://api.netatmo.com/api/getpublicdata", params=params)
+            response = await _request("POST", "https://api.netatmo.com/api/getpublicdata", sem=sem,
+                                      params=params, headers=headers)
+            if response.status_code == 304:
+                #nothing changed since the cached response
+                return(cached[2])
             response.raise_for_status()
-            data = response.json()["body"]
-            for station in data:
-            #find each value for each station
-                _id = station['_id']
-                mod = [n for n in station['modules'] if n.startswith('02:')]
-                location = station['place']['location']
-                altitude = station['place']['altitude']
-                if 'city' in station['place'].keys():
-                    city = station['place']['city']
-                else:
-                    city = 'no city'
-                ids[_id] = ({'module_name':mod, 'location':location, 'altitude':altitude,
-                             'city':city, 'full_modules':station['modules']})
-
-            #Checking that some data has been returned
-            if len(ids) == 0:
-            #if everything works but we have no data returned in the given box, raise
-                raise NameError('length')                
-        except requests.exceptions.HTTPError as error:
-            #if there's an error, try four more times before moving on
+        except httpx.HTTPStatusError as error:
+            #_request has already retried transient errors, move on to the next area
             print(error.response.status_code, error.response.text)
-            if retry_count < 5:
-                retry_count += 1
-            else:
-                return({})
-        except NameError:
-            if retry_count < 5:
-                retry_count += 1
-            else:
-                return({})
-        else:
-            NoResponse = False
-            return(ids)
+            return(_new_station_columns())
+        except httpx.TransportError as error:
+            print("Error:", repr(error))
+            return(_new_station_columns())
+
+        data = orjson.loads(response.content)["body"]
+        ids = _new_station_columns()
+        for station in data:
+        #find each value for each station
+            _id = station['_id']
+            #outdoor modules have MAC addresses starting with '02:'
+            mod = [n for n in station['modules'] if n[:3] == '02:']
+            place = station['place']
+            location = place['location']
+            altitude = place['altitude']
+            city = place.get('city', 'no city')
+            ids['MAC_address'].append(_id)
+            ids['module_name'].append(mod)
+            ids['latitude'].append(location[0])
+            ids['longitude'].append(location[1])
+            ids['altitude'].append(altitude)
+            ids['city'].append(city)
+            ids['full_modules'].append(station['modules'])
+
+        #Checking that some data has been returned
+        if len(ids['MAC_address']) == 0 and attempt < retries:
+        #if everything works but we have no data returned in the given box, try again
+            continue
+
+        #the last answer for an empty box is cached too, so re-runs can get a 304 for it
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            _ETAG_CACHE[bbox] = (etag, last_modified, ids)
+        return(ids)
+
+def get_ids(access_token, lat_ne, lon_ne, lat_sw, lon_sw):
+    """
+    Synchronous wrapper around get_ids_async.
+    """
+    return run(get_ids_async(access_token, lat_ne, lon_ne, lat_sw, lon_sw))
+
+async def get_ids_tiled_async(access_token, lat_ne, lon_ne, lat_sw, lon_sw, n=8, concurrency=8):
+    """
+    Get IDs of stations within a given region by sweeping it as a grid of tiles.
+
+    getpublicdata caps the number of stations returned per request, so the
+    region is split into n x n sub-boxes that are queried concurrently. Many
+    tiles are legitimately empty, so each tile is requested only once.
+
+    Args:
+        access_token (str): Access token.
+        lat_ne (float): Latitude of the northeast corner of the region.
+        lon_ne (float): Longitude of the northeast corner of the region.
+        lat_sw (float): Latitude of the southwest corner of the region.
+        lon_sw (float): Longitude of the southwest corner of the region.
+        n (int, optional): Number of tiles along each axis. Defaults to 8.
+        concurrency (int, optional): Maximum number of requests in flight. Defaults to 8.
+
+    Returns:
+        dict: Station data as parallel column lists keyed by column name.
+    """
+    lats = np.linspace(lat_sw, lat_ne, n + 1)
+    lons = np.linspace(lon_sw, lon_ne, n + 1)
+    tiles = [(float(lats[i + 1]), float(lons[j + 1]), float(lats[i]), float(lons[j]))
+             for i in range(n) for j in range(n)]
+
+    sem = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.ensure_future(get_ids_async(access_token, *tile, retries=0, sem=sem)) for tile in tiles]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # Don't leave the other tiles pending on the shared loop
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    # Stations on a tile edge can be returned twice, keep the first copy
+    ids = _new_station_columns()
+    seen = set()
+    for tile_ids in results:
+        for row, mac_address in enumerate(tile_ids['MAC_address']):
+            if mac_address in seen:
+                continue
+            seen.add(mac_address)
+            for name, column in ids.items():
+                column.append(tile_ids[name][row])
+    return ids
+
+def get_ids_tiled(access_token, lat_ne, lon_ne, lat_sw, lon_sw, n=8):
+    """
+    Synchronous wrapper around get_ids_tiled_async.
+    """
+    return run(get_ids_tiled_async(access_token, lat_ne, lon_ne, lat_sw, lon_sw, n))
+
+def save_netatmo_data_to_parquet(ids, parquet_file):
+    """
+    Save Netatmo station data to a Parquet file.
+
+    Args:
+        ids (dict): Station data as parallel column lists keyed by column name.
+        parquet_file (str): Name of the Parquet file to save the data.
+    """
+    table = pa.Table.from_pydict(ids, schema=_STATION_SCHEMA)
+    pq.write_table(table, parquet_file)
+    return parquet_file
 
 def save_netatmo_data_to_csv(ids, csv_file):
     """
-    Save Netatmo station data to a CSV file.
+    Save Netatmo station data to a CSV file for reading by hand.
 
     Args:
-        ids (dict): Dictionary containing station IDs and their information.
+        ids (dict): Station data as parallel column lists keyed by column name.
         csv_file (str): Name of the CSV file to save the data.
     """
-    with open(csv_file, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow(['MAC_address', 'module_name', 'latitude', 'longitude', 'altitude', 'city', 'full_modules'])
-        for mac_address, value in ids.items():
-            latitude, longitude = value['location']
-            writer.writerow([mac_address, value['module_name'], latitude, longitude, value['altitude'], value['city'], value['full_modules']])
+    # Keep the values as objects so a mixed altitude column is not upcast to
+    # float64, which would write 30.0 where the API returned 30
+    df = pd.DataFrame(ids, columns=_STATION_SCHEMA.names, dtype=object)
+    for column in ('latitude', 'longitude', 'altitude'):
+        kind = infer_dtype(df[column], skipna=True)
+        if kind == 'integer':
+            df[column] = df[column].astype('Int64')
+        elif kind == 'floating':
+            df[column] = df[column].astype('float64')
+    # Let pandas format the rows in C
+    df.to_csv(csv_file, index=False, encoding='utf-8')
     return csv_file
 
-def get_historical_measurements(access_token, device_id, module_id, scale, types, date_begin, date_end, limit=1024):
+def _measure_params(access_token, device_id, module_id, scale, types, date_begin, date_end, limit):
+    """
+    Build the query parameters for a getmeasure request.
+    """
+    return {
+        'access_token': access_token,
+        'device_id': device_id,
+        'module_id': module_id,
+        'scale': scale,
+        'type': types,
+        'date_begin': date_begin,
+        'date_end': date_end,
+        'limit': limit
+    }
+
+async def get_historical_measurements_async(access_token, device_id, module_id, scale, types, date_begin, date_end, limit=1024):
     """
     Get historical measurements for a specific device and module.
 
@@ -179,46 +568,136 @@ def get_historical_measurements(access_token, device_id, module_id, scale, types
 
     Returns:
         dict: Historical measurements data.
+
+    Raises:
+        httpx.HTTPStatusError: If the access token was missing, invalid or expired.
     """
-    url = "https://api.netatmo.net/api/getmeasure"
-    
-    params = {
-        'access_token': access_token,
-        'device_id': device_id,
-        'module_id': module_id,
-        'scale': scale,
-        'type': types,
-        'date_begin': date_begin,
-        'date_end': date_end,
-        'limit': limit
-    }
+    params = _measure_params(access_token, device_id, module_id, scale, types, date_begin, date_end, limit)
+    measurements, _ = await _fetch_measure(params)
+    return measurements
 
-    response = requests.get(url, params=params)
+def get_historical_measurements(access_token, device_id, module_id, scale, types, date_begin, date_end, limit=1024):
+    """
+    Synchronous wrapper around get_historical_measurements_async.
+    """
+    return run(get_historical_measurements_async(access_token, device_id, module_id, scale, types,
+                                                 date_begin, date_end, limit))
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        return None
-    
-def load_device_and_module_ids_from_csv(csv_file):
+def iter_device_module_ids(csv_file):
     """
-    Load device and module IDs from a CSV file.
+    Lazily read device and module IDs from a CSV file.
 
     Args:
         csv_file (str): Path to the CSV file containing device and module IDs.
 
-    Returns:
-        list: List of tuples containing device and module IDs.
+    Yields:
+        tuple: Device ID and module ID, one pair per outdoor module.
     """
-    device_module_ids = []
     with open(csv_file, mode='r', newline='', encoding='utf-8') as file:
         reader = csv.reader(file)
         next(reader)  # Skip the header row
         for row in reader:
             device_id = row[0]
-            module_id = row[1].strip("[]'")  # Remove square brackets and single quotes
-            device_module_ids.append((device_id, module_id))
-    return device_module_ids
+            # module_name holds a Python list literal, e.g. "['02:00:00:29:24:3c']"
+            for module_id in ast.literal_eval(row[1]):
+                yield device_id, module_id
+
+def iter_device_module_ids_from_parquet(parquet_file):
+    """
+    Lazily read device and module IDs from a Parquet file.
+
+    Args:
+        parquet_file (str): Path to the Parquet file containing device and module IDs.
+
+    Yields:
+        tuple: Device ID and module ID, one pair per outdoor module.
+    """
+    for batch in pq.ParquetFile(parquet_file).iter_batches(columns=['MAC_address', 'module_name']):
+        columns = batch.to_pydict()
+        for device_id, module_ids in zip(columns['MAC_address'], columns['module_name']):
+            for module_id in module_ids or ():
+                yield device_id, module_id
+
+def load_device_and_module_ids_from_csv(csv_file):
+    """
+    Load device and module IDs from a CSV file.
+
+    Args:
+        csv_file (str): Path to the CSV file containing device and module IDs.
+
+    Returns:
+        list: List of tuples containing device and module IDs.
+    """
+    return list(iter_device_module_ids(csv_file))
+
+def _measurements_frame(measurements):
+    """
+    Flatten one batch of measurements into a DataFrame with UNIX acquisition times.
+    """
+    values = [value for entry in measurements['body'] for value in entry['value']]
+    df = pd.DataFrame(values, columns=['temperature', 'humidity', 'pressure'], dtype=object)
+    # Nulls would upcast an integer column to float64 and write 60.0 instead of 60,
+    # so integer readings go to the nullable Int64 type and the rest to float64
+    for column in df.columns:
+        df[column] = df[column].astype('Int64' if infer_dtype(df[column], skipna=True) == 'integer' else 'float64')
+
+    step_time = 86400
+    # step_time = measurements['body'][0]['step_time']
+    acquisition_time = measurements['body'][0]['beg_time'] + step_time * np.arange(len(df), dtype=np.int64)
+    df.insert(0, 'acquisition_time', acquisition_time)
+    return df
+
+def _format_acquisition_times(acquisition_time):
+    """
+    Format UNIX timestamps as 'yyyymmddhhmm' strings.
+    """
+    # Format every timestamp in one numpy call instead of strftime per sample
+    labels = np.datetime_as_string(np.asarray(acquisition_time).astype('datetime64[s]'), unit='m')
+    return np.char.translate(labels, _ACQUISITION_TIME_TABLE)
+
+class MeasurementSink:
+    """
+    Append measurements for one device and module to its CSV file.
+
+    The file is opened on the first write and stays open until the sink is
+    exited, so consecutive batches are written without reopening it.
+
+    Args:
+        device_id (str): Device ID.
+        module_id (str): Module ID.
+    """
+    def __init__(self, device_id, module_id):
+        # Remove ":" from device and module IDs for filename
+        device_id_filename = device_id.replace(":", "")
+        module_id_filename = module_id.replace(":", "")
+
+        self.filename = f'{device_id_filename}_{module_id_filename}_measurements.csv'
+        self._file = None
+        self._write_header = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, measurements):
+        """
+        Append one batch of measurements to the file.
+
+        Args:
+            measurements (dict): Measurements data.
+        """
+        if self._file is None:
+            self._file = open(self.filename, 'a', newline='')
+            # Skip writing header if file is not empty
+            self._write_header = self._file.tell() == 0
+        df = _measurements_frame(measurements)
+        df['acquisition_time'] = _format_acquisition_times(df['acquisition_time'])
+        df.to_csv(self._file, header=self._write_header, index=False)
+        self._write_header = False
 
 def save_measurements_to_csv(measurements, device_id, module_id):
     """
@@ -229,40 +708,105 @@ def save_measurements_to_csv(measurements, device_id, module_id):
         device_id (str): Device ID.
         module_id (str): Module ID.
     """
-    # Remove ":" from device and module IDs for filename
-    device_id_filename = device_id.replace(":", "")
-    module_id_filename = module_id.replace(":", "")
-    
-    filename = f'{device_id_filename}_{module_id_filename}_measurements.csv'
-    
-    with open(filename, 'a', newline='') as csvfile:
-        fieldnames = ['acquisition_time', 'temperature', 'humidity', 'pressure']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        # Skip writing header if file is not empty
-        if csvfile.tell() == 0:
-            writer.writeheader()
-
-        acquisition_time = measurements['body'][0]['beg_time']
-        step_time = 86400
-        # step_time = measurements['body'][0]['step_time']
-        for entry in measurements['body']:
-            for value in entry['value']:
-                row = {
-                    'acquisition_time': datetime.utcfromtimestamp(acquisition_time).strftime('%Y%m%d%H%M'),
-                    'temperature': value[0],
-                    'humidity': value[1],
-                    'pressure': value[2]
-                }
-                writer.writerow(row)
-                acquisition_time += step_time
-
-def get_historical_measurements_batch(access_token, device_id, module_id, scale, types, date_begin, date_end, limit=1024):
-    """
-    Get historical measurements in batches to avoid rate limits.
+    with MeasurementSink(device_id, module_id) as sink:
+        sink.write(measurements)
+
+class MeasurementStore:
+    """
+    Append measurements for every device to a single DuckDB table.
+
+    Batches can be written from several threads; the DataFrames are built in
+    parallel and only the insert itself is serialised.
 
     Args:
-        access_token (str): Access token.
+        db_path (str): Path to the DuckDB database file.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._con = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._con = duckdb.connect(self.db_path)
+        self._con.execute(
+            'CREATE TABLE IF NOT EXISTS measurements ('
+            'device_id TEXT, module_id TEXT, acquisition_time BIGINT, '
+            'temperature DOUBLE, humidity DOUBLE, pressure DOUBLE)'
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._con.close()
+        self._con = None
+
+    def write(self, measurements, device_id, module_id):
+        """
+        Append one batch of measurements to the table.
+
+        Args:
+            measurements (dict): Measurements data.
+            device_id (str): Device ID.
+            module_id (str): Module ID.
+        """
+        df = _measurements_frame(measurements)
+        df.insert(0, 'device_id', device_id)
+        df.insert(1, 'module_id', module_id)
+        with self._lock:
+            self._con.append('measurements', df)
+
+def _is_token_error(response):
+    """
+    Tell whether a response rejected the access token rather than the request.
+
+    Args:
+        response (httpx.Response): Response to inspect.
+
+    Returns:
+        bool: True for Netatmo's 'access token missing', 'invalid' and 'expired' errors.
+    """
+    if response.status_code not in (401, 403):
+        return False
+    try:
+        code = orjson.loads(response.content)['error']['code']
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        return response.status_code == 401
+    return code in _TOKEN_ERROR_CODES
+
+async def _fetch_measure(params, sem=None):
+    """
+    Fetch a single page of measurements.
+
+    Args:
+        params (dict): Query parameters for the getmeasure request.
+        sem (asyncio.Semaphore, optional): Semaphore bounding the number of
+            in-flight requests. Defaults to None (unbounded).
+
+    Returns:
+        tuple: Historical measurements data, or None if the request failed, and
+            the number of seconds to wait before the next request.
+
+    Raises:
+        httpx.HTTPStatusError: If the access token was missing, invalid or expired.
+    """
+    url = "https://api.netatmo.net/api/getmeasure"
+
+    response = await _request("GET", url, sem=sem, params=params)
+    if response.status_code == 200:
+        return orjson.loads(response.content), _sleep_hint(response)
+    if _is_token_error(response):
+        # Not the end of this device's data, so don't report it as such
+        response.raise_for_status()
+    return None, _sleep_hint(response)
+
+async def get_historical_measurements_batch(access_token, device_id, module_id, scale, types, date_begin, date_end, limit=1024, sem=None):
+    """
+    Get historical measurements in batches, yielding each batch as it arrives.
+
+    Args:
+        access_token (str or callable): Access token, or a coroutine function
+            returning one. A function is called before every batch, so a long
+            download picks up refreshed tokens, and once more after the API
+            rejects a token.
         device_id (str): Device ID.
         module_id (str): Module ID.
         scale (str): Scale of the measurements (e.g., '1day').
@@ -270,32 +814,125 @@ def get_historical_measurements_batch(access_token, device_id, module_id, scale,
         date_begin (int): Start timestamp.
         date_end (int): End timestamp.
         limit (int, optional): Limit of measurements. Defaults to 1024.
+        sem (asyncio.Semaphore, optional): Semaphore bounding the number of
+            in-flight requests. Defaults to None (unbounded).
 
-    Returns:
-        list: List of historical measurements data.
-    """
-    all_measurements = []
+    Yields:
+        dict: Historical measurements data for one batch.
 
+    Raises:
+        httpx.HTTPStatusError: If the access token is rejected and no fresh one can be used.
+    """
+    retried_token = False
     while date_begin < date_end:
-        measurements = get_historical_measurements(access_token, device_id, module_id, scale, types, date_begin, date_end, limit)
+        token = await access_token() if callable(access_token) else access_token
+        params = _measure_params(token, device_id, module_id, scale, types, date_begin, date_end, limit)
+        try:
+            measurements, sleep_hint = await _fetch_measure(params, sem)
+        except httpx.HTTPStatusError:
+            if not callable(access_token) or retried_token:
+                raise
+            # The token was rejected before its expiry time, force a refresh and try again
+            _drop_cached_token(token)
+            retried_token = True
+            continue
+        retried_token = False
         if measurements is None or "body" not in measurements or not measurements["body"]:
             # No more data available or an error occurred, stop the loop
             break
 
         # Extract the last timestamp from the received data
         last_timestamp = measurements["body"][-1]["beg_time"]
-        
-        # Append the measurements to the list
-        all_measurements.extend(measurements["body"])
 
         # Update date_begin to fetch the next batch of data
         date_begin = last_timestamp + 86400
         # date_begin = last_timestamp + measurements["body"][-1]["step_time"]
 
-        # Save measurements to CSV file
-        save_measurements_to_csv(measurements, device_id, module_id)
+        yield measurements
+
+        # Only pause when the server says the quota is nearly used up
+        if sleep_hint:
+            await asyncio.sleep(sleep_hint)
+
+async def _download_device_measurements(store, access_token, device_id, module_id, scale, types, date_begin, date_end, limit, sem=None):
+    """
+    Download every batch for one device and module and save it to the store.
+
+    Fetching and writing overlap: a producer task pushes each batch onto a
+    queue while the inserts run in a worker thread.
+    """
+    queue = asyncio.Queue(maxsize=8)
+    loop = asyncio.get_running_loop()
 
-        # Introduce a delay to avoid hitting rate limits
-        time.sleep(1)
+    async def produce():
+        cancelled = False
+        try:
+            async with aclosing(get_historical_measurements_batch(access_token, device_id, module_id, scale, types,
+                                                                  date_begin, date_end, limit, sem=sem)) as batches:
+                async for measurements in batches:
+                    await queue.put(measurements)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Tell the consumer there are no more batches, unless it has
+            # stopped reading and cancelled us, when the put could never finish
+            if not cancelled:
+                await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (measurements := await queue.get()) is not None:
+            await loop.run_in_executor(None, store.write, measurements, device_id, module_id)
+    except BaseException:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        raise
+    # Surface any error raised while fetching
+    await producer
+    print(f'--------data for {device_id, module_id} completely downloaded----------')
+
+async def get_historical_measurements_all(access_token, device_module_ids, scale, types, date_begin, date_end, limit=1024, concurrency=10,
+                                          db_path='netatmo.duckdb'):
+    """
+    Download historical measurements for many devices concurrently.
 
-    return all_measurements
+    Args:
+        access_token (str or callable): Access token, or a coroutine function
+            returning one. Pass a function for long sweeps, so the token is
+            refreshed before it expires.
+        device_module_ids (iterable): Tuples of device and module IDs. It is
+            consumed lazily, so a generator can be passed.
+        scale (str): Scale of the measurements (e.g., '1day').
+        types (str): Types of measurements (e.g., 'Temperature,Humidity,Pressure').
+        date_begin (int): Start timestamp.
+        date_end (int): End timestamp.
+        limit (int, optional): Limit of measurements. Defaults to 1024.
+        concurrency (int, optional): Number of devices downloaded at once, kept
+            low to stay under Netatmo's per-user rate limit. Defaults to 10.
+        db_path (str, optional): DuckDB database the measurements are appended to.
+            Defaults to 'netatmo.duckdb'.
+    """
+    device_module_ids = iter(device_module_ids)
+
+    async def worker(store):
+        # Each worker pulls the next pair as soon as it is free, so the IDs
+        # never have to be held in memory all at once
+        for device_id, module_id in device_module_ids:
+            try:
+                await _download_device_measurements(store, access_token, device_id, module_id,
+                                                    scale, types, date_begin, date_end, limit)
+            except httpx.TransportError as error:
+                # _request has already retried, skip this device and keep the sweep going
+                print(f'--------download for {device_id, module_id} failed: {error!r}----------')
+
+    with MeasurementStore(db_path) as store:
+        workers = [asyncio.ensure_future(worker(store)) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # Don't leave workers pending on the shared loop once the store is closed
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise